@@ -12,7 +12,7 @@
       https://coincheck.com/ja/send
     5. 受信履歴：~/Downloads/deposits.csv
       https://coincheck.com/ja/deposit_bitcoin
-    6. その他： 92行目付近（2段階認証の報酬など）
+    6. その他： get_trades内（2段階認証の報酬など）
 
   Output:
     1. 取引履歴一覧とProfit/Loss
@@ -33,20 +33,32 @@
 
 """
 import os
+import sys
 from datetime import datetime, timedelta
 from pathlib import Path
 import csv
+import calendar
+import json
+import tempfile
 from pprint import pprint
 from decimal import Decimal, getcontext
+from functools import lru_cache
+from contextlib import contextmanager
+from heapq import merge
+from bisect import bisect_left
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 # 有効桁数は少数第8位
 getcontext().prec = 8
+# 残高の初期値（数量, 価格）
+EMPTY_BALANCE = (Decimal(0), Decimal(0))
 
 def load_csv(path):
   with open(path, newline="") as f:
-    reader = csv.DictReader(f, delimiter=",")
-    return [row for row in reader]
+    # 1行ずつ返し、CSV全体をメモリに載せない.
+    yield from csv.DictReader(f, delimiter=",")
 
 def load_activities():
   return (load_csv(os.path.join(Path.home(), "Downloads", "orders.csv")),
@@ -55,11 +67,12 @@ def load_activities():
     load_csv(os.path.join(Path.home(), "Downloads", "sends.csv")),
     load_csv(os.path.join(Path.home(), "Downloads", "deposits.csv")))
 
-def get_trades(orders, buys, sells, sends, deposits):
-  """日付の降順でトレード内容を返却する."""
-  items = []
+# 通貨名はinternしておき、残高テーブルの検索を同一性比較で済ませる.
+_currency = sys.intern
+
+def _trades_from_orders(orders):
   for trade in orders:
-    items.append({
+    yield {
       "Order"             : "trade",
       "Date"              : trade["Date"],
       "Type"              : trade["Type"],
@@ -68,162 +81,243 @@ def get_trades(orders, buys, sells, sends, deposits):
       "Price"             : Decimal(trade["JPY"]),
       "Trading Currency"  : "BTC",
       "Original Currency" : "JPY"
-    })
+    }
+
+def _trades_from_buys(buys):
   for buy in buys:
     if buy["Progress"] == "completed":
-      items.append({
+      amount, price = Decimal(buy["Amount"]), Decimal(buy["Price"])
+      yield {
         "Order"            : "buy",
         "Date"             : buy["Time"],
         "Type"             : "buy" if buy["Original Currency"] == "JPY" else "exchange",
-        "Amount"           : Decimal(buy["Amount"]),
-        "Rate"             : Decimal(buy["Price"]) / Decimal(buy["Amount"]),
-        "Price"            : Decimal(buy["Price"]),
-        "Trading Currency" : buy["Trading Currency"],
-        "Original Currency": buy["Original Currency"]
-      })
+        "Amount"           : amount,
+        "Rate"             : price / amount,
+        "Price"            : price,
+        "Trading Currency" : _currency(buy["Trading Currency"]),
+        "Original Currency": _currency(buy["Original Currency"])
+      }
+
+def _trades_from_sells(sells, last_buy):
   for sell in sells:
     if sell["Progress"] == "completed":
-      items.append({
+      amount, price = Decimal(sell["Amount"]), Decimal(sell["Price"])
+      yield {
         "Order"            : "sell",
         "Date"             : sell["Time"],
-        "Type"             : "sell" if buy["Original Currency"] == "JPY" else "exchange",
-        "Amount"           : Decimal(sell["Amount"]) * -1,
-        "Rate"             : Decimal(sell["Price"]) / Decimal(sell["Amount"]),
-        "Price"            : Decimal(sell["Price"]),
-        "Trading Currency" : sell["Trading Currency"],
-        "Original Currency": sell["Original Currency"]
-      })
+        "Type"             : "sell" if last_buy["Original Currency"] == "JPY" else "exchange",
+        "Amount"           : amount * -1,
+        "Rate"             : price / amount,
+        "Price"            : price,
+        "Trading Currency" : _currency(sell["Trading Currency"]),
+        "Original Currency": _currency(sell["Original Currency"])
+      }
+
+def _trades_from_sends(sends):
   for send in sends:
     if send["Status"] == "confirmed":
-      items.append({
+      yield {
         "Order"            : "send",
         "Date"             : send["Date"],
         "Type"             : "send",
         "Amount"           : Decimal(send["Amount"]) * -1,
         "Fee"              : Decimal(send["Fee"]),
-        "Trading Currency" : send["Currency"],
-      })
+        "Trading Currency" : _currency(send["Currency"]),
+      }
+
+def _trades_from_deposits(deposits):
   for deposit in deposits:
     if deposit["Status"] == "confirmed":
-      items.append({
+      yield {
         "Order"            : "deposit",
         "Date"             : deposit["Date"],
         "Type"             : "deposit",
         "Amount"           : Decimal(deposit["Amount"]),
-        "Trading Currency" : deposit["Currency"],
-      })
+        "Trading Currency" : _currency(deposit["Currency"]),
+      }
+
+def get_trades(orders, buys, sells, sends, deposits):
+  """日付の昇順でトレード内容を返却する."""
   # 2段階認証の報酬をdepositで処理.
-  items.append({
+  bonuses = [{
     "Order"            : "deposit",
     "Date"             : "2017-09-05",
     "Type"             : "deposit",
     "Amount"           : Decimal(0.0003),
     "Trading Currency" : "BTC",
-  })
-  return sorted(items, key=lambda d:d["Date"])
+  }]
+  # 売却の種別は従来どおり購入履歴の最終行の交換元で判定する.
+  buys = list(buys)
+  last_buy = buys[-1] if buys else None
+  # ソースごとに日付順に並べてからマージする.
+  by_date = itemgetter("Date")
+  sources = (_trades_from_orders(orders),
+    _trades_from_buys(buys),
+    _trades_from_sells(sells, last_buy),
+    _trades_from_sends(sends),
+    _trades_from_deposits(deposits),
+    bonuses)
+  return list(merge(*(sorted(source, key=by_date) for source in sources), key=by_date))
+
+# HTTP接続は使い回す.
+session = requests.Session()
 
-api_cache = {}
+# 月末日の終値まで揃った（確定済みの）終値一覧はディスクにも保存する.
+price_cache_dir = os.path.join(Path.home(), ".cache", "cc-pl", "closing_prices")
+
+@lru_cache(maxsize=None)
+def _fetch_month(year, month):
+  """指定月の終値一覧を取得する（月単位でキャッシュ）."""
+  last_day = "{}-{:02d}-{:02d}".format(year, month, calendar.monthrange(year, month)[1])
+  path = os.path.join(price_cache_dir, "{}-{:02d}.json".format(year, month))
+  if os.path.exists(path):
+    with open(path) as f:
+      closing_prices = json.load(f)
+    # 月末日が欠けたキャッシュは信用せず取得し直す.
+    if last_day in closing_prices:
+      return closing_prices
+  url = "https://coincheck.com/exchange/closing_prices/list?month={}&year={}".format(month, year)
+  closing_prices = session.get(url).json()["closing_prices"]
+  if last_day in closing_prices:
+    # 保存に失敗しても取得した結果はそのまま使う.
+    try:
+      os.makedirs(price_cache_dir, exist_ok=True)
+      with tempfile.NamedTemporaryFile("w", dir=price_cache_dir, suffix=".tmp", delete=False) as f:
+        json.dump(closing_prices, f)
+      os.replace(f.name, path)
+    except OSError:
+      pass
+  return closing_prices
 
 def get_price(dt, currency):
-  if dt not in api_cache:
-    year, month, _ = dt.split("-")
-    url = "https://coincheck.com/exchange/closing_prices/list?month={}&year={}".format(int(month), int(year))
-    result = requests.get(url).json()
-    api_cache[dt] = result
-  price = Decimal(api_cache[dt]["closing_prices"][dt][currency.lower()][1])
+  closing_prices = _fetch_month(int(dt[:4]), int(dt[5:7]))
+  price = Decimal(closing_prices[dt][currency.lower()][1])
   # print("price:", dt, currency, price)
   return price
 
+def _prefetch_month(year, month):
+  # 失敗はここでは無視する（キャッシュされないので、使う時点で取得し直して同じ例外になる）.
+  try:
+    _fetch_month(year, month)
+  except Exception:
+    pass
+
+def prefetch_prices(dates):
+  """必要な月の終値一覧を並列に取得しておく."""
+  months = {(int(dt[:4]), int(dt[5:7])) for dt in dates}
+  with ThreadPoolExecutor(max_workers=8) as executor:
+    list(executor.map(lambda ym: _prefetch_month(*ym), months))
+
+@contextmanager
+def buffered_lines():
+  """出力行を溜めておき、ブロックを抜けるときにまとめて書き出す（途中で失敗してもそれまでの行は出力する）."""
+  lines = []
+  try:
+    yield lines
+  finally:
+    sys.stdout.write("\n".join(lines) + "\n")
+
 def main():
   """メイン処理"""
   # 取引履歴, 購入履歴、売却履歴、送信履歴、受信履歴
   orders, buys, sells, sends, deposits = load_activities()
 
+  trades = get_trades(orders, buys, sells, sends, deposits)
+  # 対象は2017-12-31まで（日付順なので二分探索で切り出す）.
+  trades = trades[:bisect_left([t["Date"] for t in trades], "2018-01-01")]
+  yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+  # 時価が必要な月（交換・送信・受信、期末残高）を先に取得する
+  dates = [t["Date"] for t in trades if t["Type"] in ("exchange", "send", "deposit")]
+  prefetch_prices(dates + [yesterday])
+
   # 取引記録を作成する
-  print("{:14},{:4},{:9},{:12},{:12},{:11},{}".format('order', 'currency', 'type', 'date', 'amount', 'price', 'profit'))
+  row = "{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format
   table = {}
-  for trade in get_trades(orders, buys, sells, sends, deposits):
-    dt = trade["Date"].split(" ")[0]
-    # 対象は2017-12-31まで.
-    if dt >= "2018-01-01":
-      continue
-    # 購入
-    if trade["Type"] == "buy":
-      amount, price = table.get(trade["Trading Currency"], (0, 0))
-      # 加重平均の価格
-      price = (price * amount + trade["Rate"] * Decimal(trade["Amount"])) / (amount + trade["Amount"])
-      # 数量
-      amount += trade["Amount"]
-      # 保存
-      table[trade["Trading Currency"]] = (amount, price)
-      # 出力
-      print("{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format(trade["Order"], trade["Trading Currency"], 'buy', dt, amount, int(price), ''))
-    # 売却
-    elif trade["Type"] == "sell":
-      amount, price = table.get(trade["Trading Currency"], (0, 0))
-      amount += trade["Amount"]
-      profit = (trade["Rate"] - price) * trade["Amount"] * -1
-      # 保存
-      table[trade["Trading Currency"]] = (amount, price)
-      # 出力
-      print("{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format(trade["Order"], trade["Trading Currency"], 'sell', dt, amount, int(price), int(profit)))
-    # 交換
-    elif trade["Type"] == "exchange":
-      # pprint(trade)
-      # 交換元は売却として処理.
-      buy_price = get_price(dt, trade["Original Currency"])
-      buy_amount = trade["Price"] * -1
-      amount, price = table.get(trade["Original Currency"], (0, 0))
-      amount += buy_amount
-      profit = (buy_price - price) * buy_amount * -1
-      # 保存
-      table[trade["Original Currency"]] = (amount, price)
-      # 出力
-      print("{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format(trade["Order"] + "(exchange)", trade["Original Currency"], 'sell', dt, amount, int(price), int(profit)))
-      # 交換先は購入として処理.
-      amount, price = table.get(trade["Trading Currency"], (0, 0))
-      # 加重平均の価格
-      buy_rate = buy_price * buy_amount * -1 / trade["Amount"]
-      # print("buy_rate:", buy_rate, buy_price, buy_amount)
-      price = (price * amount + buy_rate) * trade["Amount"] / (amount + trade["Amount"])
-      # 数量
-      amount += trade["Amount"]
-      # 保存
-      table[trade["Trading Currency"]] = (amount, price)
-      # 出力
-      print("{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format(trade["Order"] + "(exchange)", trade["Trading Currency"], 'buy', dt, amount, int(price), ''))
-    # 送信
-    elif trade["Type"] == "send":
-      amount, price = table.get(trade["Trading Currency"], (0, 0))
-      amount += trade["Amount"]
-      amount -= trade["Fee"]
-      table[trade["Trading Currency"]] = (amount, price)
-      rate = get_price(dt, trade["Trading Currency"])
-      profit = trade["Fee"] * rate * -1
-      # 出力
-      print("{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format(trade["Order"], trade["Trading Currency"], 'send', dt, amount, int(price), int(profit)))
-    # 受け取り
-    elif trade["Type"] == "deposit":
-      amount, price = table.get(trade["Trading Currency"], (0, 0))
-      rate = get_price(dt, trade["Trading Currency"])
-      # 加重平均の価格
-      price = (price * amount + rate * trade["Amount"]) / (amount + trade["Amount"])
-      # 数量
-      amount += trade["Amount"]
-      profit = rate * trade["Amount"]
-      # 保存
-      table[trade["Trading Currency"]] = (amount, price)
-      # 出力
-      print("{:14},{:4},{:9},{:<12},{:<12},{:<11},{}".format(trade["Order"], trade["Trading Currency"], 'deposit', dt, amount, int(price), profit))
+  with buffered_lines() as lines:
+    lines.append("{:14},{:4},{:9},{:12},{:12},{:11},{}".format('order', 'currency', 'type', 'date', 'amount', 'price', 'profit'))
+    for trade in trades:
+      dt = trade["Date"][:10]
+      order, trade_type, currency, quantity = trade["Order"], trade["Type"], trade["Trading Currency"], trade["Amount"]
+      # 購入
+      if trade_type == "buy":
+        amount, price = table.get(currency, EMPTY_BALANCE)
+        # 加重平均の価格
+        price = (price * amount + trade["Rate"] * quantity) / (amount + quantity)
+        # 数量
+        amount += quantity
+        # 保存
+        table[currency] = (amount, price)
+        # 出力
+        lines.append(row(order, currency, 'buy', dt, amount, int(price), ''))
+      # 売却
+      elif trade_type == "sell":
+        amount, price = table.get(currency, EMPTY_BALANCE)
+        amount += quantity
+        profit = (trade["Rate"] - price) * quantity * -1
+        # 保存
+        table[currency] = (amount, price)
+        # 出力
+        lines.append(row(order, currency, 'sell', dt, amount, int(price), int(profit)))
+      # 交換
+      elif trade_type == "exchange":
+        # pprint(trade)
+        # 交換元は売却として処理.
+        original = trade["Original Currency"]
+        buy_price = get_price(dt, original)
+        buy_amount = trade["Price"] * -1
+        amount, price = table.get(original, EMPTY_BALANCE)
+        amount += buy_amount
+        profit = (buy_price - price) * buy_amount * -1
+        # 保存
+        table[original] = (amount, price)
+        # 出力
+        lines.append(row(order + "(exchange)", original, 'sell', dt, amount, int(price), int(profit)))
+        # 交換先は購入として処理.
+        amount, price = table.get(currency, EMPTY_BALANCE)
+        # 加重平均の価格
+        buy_rate = buy_price * buy_amount * -1 / quantity
+        # print("buy_rate:", buy_rate, buy_price, buy_amount)
+        price = (price * amount + buy_rate) * quantity / (amount + quantity)
+        # 数量
+        amount += quantity
+        # 保存
+        table[currency] = (amount, price)
+        # 出力
+        lines.append(row(order + "(exchange)", currency, 'buy', dt, amount, int(price), ''))
+      # 送信
+      elif trade_type == "send":
+        amount, price = table.get(currency, EMPTY_BALANCE)
+        amount += quantity
+        amount -= trade["Fee"]
+        table[currency] = (amount, price)
+        rate = get_price(dt, currency)
+        profit = trade["Fee"] * rate * -1
+        # 出力
+        lines.append(row(order, currency, 'send', dt, amount, int(price), int(profit)))
+      # 受け取り
+      elif trade_type == "deposit":
+        amount, price = table.get(currency, EMPTY_BALANCE)
+        rate = get_price(dt, currency)
+        # 加重平均の価格
+        price = (price * amount + rate * quantity) / (amount + quantity)
+        # 数量
+        amount += quantity
+        profit = rate * quantity
+        # 保存
+        table[currency] = (amount, price)
+        # 出力
+        lines.append(row(order, currency, 'deposit', dt, amount, int(price), profit))
 
   # 期末残高
-  print("\n----------------------------")
-  print("期末残高\n---")
-  yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-  print("{:4},{:<12},{:<12},{:<12}".format("", "Amount", "Rate", "Value"))
-  for currency, item in table.items():
-    value = int(get_price(yesterday, currency) * item[0])
-    print("{:4},{:<12},{:<12},{:<12}".format(currency, item[0], item[1], value))
+  balance_row = "{:4},{:<12},{:<12},{:<12}".format
+  with buffered_lines() as lines:
+    lines.append("\n----------------------------")
+    lines.append("期末残高\n---")
+    lines.append(balance_row("", "Amount", "Rate", "Value"))
+    for currency, (amount, price) in table.items():
+      value = int(get_price(yesterday, currency) * amount)
+      lines.append(balance_row(currency, amount, price, value))
 
 
 if __name__ == "__main__":